@@ -0,0 +1,199 @@
+import os
+import argparse
+import random
+from array import array
+
+from stage5 import write_node_json
+
+WORDS = ["alpha", "beta", "gamma", "delta", "vfs", "file", "data", "log", "test",
+         "config", "user", "home", "tmp", "hello", "world", "пример", "файл"]
+
+class TreeGenerator:
+    # the shape is fixed up front as per-level counts (nodes at each depth,
+    # entries and subdirectories per directory); the nodes themselves are
+    # generated while the writer walks the tree, so only the current
+    # depth-first path and the per-directory counts are held in memory
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.counter = 0
+        self.pool = []
+        self.levels = self.level_sizes()
+        self.plan_levels()
+
+    def level_sizes(self):
+        # number of nodes at depth 0 (the root), 1, 2, ...
+        args = self.args
+        total = args.nodes - 1
+        if total <= 0:
+            return [1]
+        if args.depth_weights:
+            weights = args.depth_weights
+        else:
+            growth, depth = self.growth(total)
+            weights = [growth ** d for d in range(depth)]
+        # at most one level per node, so every level can get at least one
+        weights = weights[:total]
+        if sum(weights) == 0:
+            weights[-1] = 1
+        scale = sum(weights)
+        sizes = [int(total * w / scale) for w in weights]
+        sizes[-1] += total - sum(sizes)
+        # every level above the deepest populated one needs a directory
+        while sizes and sizes[-1] == 0:
+            sizes.pop()
+        # (the largest level always has more than one node to give here)
+        for d in range(len(sizes) - 1):
+            if sizes[d] == 0:
+                sizes[sizes.index(max(sizes))] -= 1
+                sizes[d] = 1
+        return [1] + sizes
+
+    def growth(self, total):
+        # ratio between consecutive levels: fanout * dir_ratio if the tree
+        # fits into --max-depth that way, otherwise the smallest ratio that
+        # fits (directories then grow past --fanout only if they must)
+        args = self.args
+        capacity = lambda g, depth: args.fanout * sum(g ** d for d in range(depth))
+        preferred = args.fanout * args.dir_ratio
+        for depth in range(1, args.max_depth + 1):
+            if capacity(preferred, depth) >= total:
+                return preferred, depth
+        lo, hi = preferred, float(max(total, 2))
+        for _ in range(100):
+            mid = (lo + hi) / 2
+            if capacity(mid, args.max_depth) >= total:
+                hi = mid
+            else:
+                lo = mid
+        return hi, args.max_depth
+
+    def plan_levels(self):
+        # entries[d][i] / subdirs[d][i]: children and subdirectories of the
+        # i-th directory at depth d, in depth-first order
+        n = self.levels
+        fanout = self.args.fanout
+        dirs = [1]
+        for d in range(1, len(n)):
+            below = n[d + 1] if d + 1 < len(n) else 0
+            dirs.append(min(n[d], -(-below // fanout)))
+        self.entries = []
+        self.subdirs = []
+        for d in range(len(n) - 1):
+            jitter = array("d", (0.5 + self.rng.random() for _ in range(dirs[d])))
+            entries = self.split(n[d + 1], jitter)
+            self.entries.append(entries)
+            self.subdirs.append(self.split(dirs[d + 1], entries, caps=entries))
+        self.cursor = [0] * len(n)
+
+    def split(self, total, weights, caps=None):
+        # integer parts of total proportional to weights, never above caps
+        scale = sum(weights) or 1
+        parts = array("I", (int(total * w / scale) for w in weights))
+        left = total - sum(parts)
+        i = self.rng.randrange(len(parts)) if parts else 0
+        while left > 0:
+            if caps is None or parts[i] < caps[i]:
+                parts[i] += 1
+                left -= 1
+            i = (i + 1) % len(parts)
+        return parts
+
+    def root(self):
+        return {"type": "dir", "mode": "rwxr-xr-x", "children": LazyChildren(self, 0)}
+
+    def next_name(self, pattern, depth):
+        self.counter += 1
+        return pattern.format(i=self.counter, depth=depth)
+
+    def content(self):
+        args = self.args
+        rng = self.rng
+        if self.pool and rng.random() < args.dup_ratio:
+            return rng.choice(self.pool)
+        size = max(0, int(rng.expovariate(1 / args.file_size))) if args.file_size else 0
+        if rng.random() < args.binary_ratio:
+            data = ("content_bytes", rng.randbytes(size))
+        else:
+            words = []
+            length = 0
+            while length < size:
+                w = rng.choice(WORDS)
+                words.append(w)
+                length += len(w) + 1
+            data = ("content", " ".join(words))
+        # bounded pool of payloads to draw duplicates from
+        if len(self.pool) < 64:
+            self.pool.append(data)
+        else:
+            self.pool[rng.randrange(64)] = data
+        return data
+
+    def file_node(self):
+        key, value = self.content()
+        return {"type": "file", "mode": "rw-r--r--", key: value}
+
+
+class LazyChildren:
+    def __init__(self, gen, depth):
+        self.gen = gen
+        self.depth = depth
+
+    def items(self):
+        gen = self.gen
+        d = self.depth
+        if d >= len(gen.entries):
+            return
+        i = gen.cursor[d]
+        gen.cursor[d] += 1
+        k = gen.entries[d][i]
+        dir_slots = set(gen.rng.sample(range(k), gen.subdirs[d][i]))
+        for j in range(k):
+            if j in dir_slots:
+                node = {"type": "dir", "mode": "rwxr-xr-x", "children": LazyChildren(gen, d + 1)}
+                yield gen.next_name(gen.args.dir_pattern, d + 1), node
+            else:
+                yield gen.next_name(gen.args.file_pattern, d + 1), gen.file_node()
+
+
+def parse_weights(text):
+    weights = [float(w) for w in text.split(",")]
+    if not weights or any(w < 0 for w in weights) or sum(weights) == 0:
+        raise ValueError(text)
+    return weights
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Генератор VFS в формате JSON (детерминированный)")
+    parser.add_argument("--out", help="Путь к выходному JSON", default=os.path.join(here, "vfs_generated.json"))
+    parser.add_argument("--nodes", help="Число узлов, включая корень", type=int, default=1000)
+    parser.add_argument("--seed", help="Seed генератора", type=int, default=0)
+    parser.add_argument("--max-depth", help="Максимальная глубина", type=int, default=8)
+    parser.add_argument("--fanout", help="Среднее число элементов в каталоге", type=int, default=10)
+    parser.add_argument("--dir-ratio", help="Желаемая доля подкаталогов среди элементов "
+                        "(задаёт рост числа узлов от уровня к уровню)", type=float, default=0.2)
+    parser.add_argument("--depth-weights", help="Доли узлов по уровням глубины, например 1,2,4,2,1 "
+                        "(заменяет --max-depth)", type=parse_weights, default=None)
+    parser.add_argument("--file-pattern", help="Шаблон имени файла ({i}, {depth})", default="file{i}.txt")
+    parser.add_argument("--dir-pattern", help="Шаблон имени каталога ({i}, {depth})", default="dir{i}")
+    parser.add_argument("--file-size", help="Средний размер файла в байтах", type=int, default=64)
+    parser.add_argument("--binary-ratio", help="Доля бинарных файлов", type=float, default=0.1)
+    parser.add_argument("--dup-ratio", help="Доля файлов с повторяющимся содержимым", type=float, default=0.0)
+    args = parser.parse_args()
+    if args.nodes < 1:
+        parser.error("--nodes must be at least 1")
+    if args.fanout < 1 or args.max_depth < 1:
+        parser.error("--fanout and --max-depth must be positive")
+    if not 0 < args.dir_ratio <= 1:
+        parser.error("--dir-ratio must be in (0, 1]")
+
+    gen = TreeGenerator(args)
+    with open(args.out, "w", encoding="utf-8") as f:
+        write_node_json(gen.root(), f)
+        f.write("\n")
+    print(f"Создан {args.out} ({gen.counter + 1} узлов)")
+
+
+if __name__ == "__main__":
+    main()
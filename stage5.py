@@ -5,7 +5,15 @@ import sys
 import json
 import base64
 import fnmatch
-import copy
+import re
+import bisect
+import functools
+from array import array
+import threading
+try:
+    import readline
+except ImportError:
+    readline = None
 
 def default_vfs():
     return {
@@ -25,11 +33,516 @@ def default_vfs():
         }
     }
 
+# permission bits, same layout as stat(2)
+PERM_BITS = [
+    (0o400, "r"), (0o200, "w"), (0o100, "x"),
+    (0o040, "r"), (0o020, "w"), (0o010, "x"),
+    (0o004, "r"), (0o002, "w"), (0o001, "x"),
+]
+S_ISUID = 0o4000
+S_ISGID = 0o2000
+S_ISVTX = 0o1000
+WHO_MASKS = {"u": 0o4700, "g": 0o2070, "o": 0o1007, "a": 0o7777}
+SYMBOLIC_RE = re.compile(r"^([ugoa]*)([-+=])([rwxXst]*)$")
+
+def mode_to_bits(mode_str):
+    # "rwxr-xr-x" -> 0o755; s/S and t/T in the x positions are special bits.
+    # Octal strings such as "755" were stored by older chmod and are accepted
+    if re.fullmatch(r"[0-7]{1,4}", mode_str):
+        return int(mode_str, 8)
+    if len(mode_str) != 9:
+        raise ValueError(f"invalid mode string: {mode_str!r}")
+    bits = 0
+    for i, (bit, ch) in enumerate(PERM_BITS):
+        c = mode_str[i]
+        if c == ch:
+            bits |= bit
+        elif i == 2 and c in "sS":
+            bits |= S_ISUID | (bit if c == "s" else 0)
+        elif i == 5 and c in "sS":
+            bits |= S_ISGID | (bit if c == "s" else 0)
+        elif i == 8 and c in "tT":
+            bits |= S_ISVTX | (bit if c == "t" else 0)
+        elif c != "-":
+            raise ValueError(f"invalid mode string: {mode_str!r}")
+    return bits
+
+def bits_to_mode(bits):
+    chars = [ch if bits & bit else "-" for bit, ch in PERM_BITS]
+    if bits & S_ISUID:
+        chars[2] = "s" if bits & 0o100 else "S"
+    if bits & S_ISGID:
+        chars[5] = "s" if bits & 0o010 else "S"
+    if bits & S_ISVTX:
+        chars[8] = "t" if bits & 0o001 else "T"
+    return "".join(chars)
+
+def parse_mode_spec(spec):
+    # returns a function (old_bits, is_dir) -> new_bits
+    if re.fullmatch(r"[0-7]{1,4}", spec):
+        value = int(spec, 8)
+        return lambda bits, is_dir: value
+    clauses = []
+    for clause in spec.split(","):
+        m = SYMBOLIC_RE.match(clause)
+        if m is None:
+            raise ValueError(f"invalid mode: {spec!r}")
+        who, op, perms = m.groups()
+        mask = 0
+        for w in who or "a":
+            mask |= WHO_MASKS[w]
+        perm = 0
+        for p in perms:
+            if p == "r":
+                perm |= 0o444
+            elif p == "w":
+                perm |= 0o222
+            elif p == "x":
+                perm |= 0o111
+            elif p == "s":
+                perm |= S_ISUID | S_ISGID
+            elif p == "t":
+                perm |= S_ISVTX
+        clauses.append((mask, op, perm, "X" in perms))
+
+    def apply(bits, is_dir):
+        for mask, op, perm, cond_x in clauses:
+            p = perm
+            # X: execute only for directories or if someone already has x
+            if cond_x and (is_dir or bits & 0o111):
+                p |= 0o111
+            p &= mask
+            if op == "+":
+                bits |= p
+            elif op == "-":
+                bits &= ~p
+            else:
+                bits = (bits & ~mask) | p
+        return bits
+    return apply
+
+def node_meta(node):
+    if node is None:
+        return None
+    meta = {"type": node.get("type"), "mode": node.get("mode", "")}
+    if node.get("type") == "file":
+        # bytes for binary files, characters for text (no re-encoding)
+        if "content_bytes" in node:
+            meta["size"] = len(node["content_bytes"])
+        else:
+            meta["size"] = len(node.get("content", ""))
+    return meta
+
+class Cancelled(Exception):
+    pass
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled("interrupted")
+
+def subtree_usage(node, check=None):
+    # estimated in-memory size of a subtree: node dicts, names, metadata and
+    # payloads (content, content_b64 and the decoded content_bytes)
+    usage = {"nodes": 0, "dirs": 0, "files": 0, "payload": 0, "memory": 0}
+    stack = [node] if node is not None else []
+    while stack:
+        if check is not None:
+            check()
+        n = stack.pop()
+        usage["nodes"] += 1
+        usage["dirs" if n.get("type") == "dir" else "files"] += 1
+        usage["memory"] += sys.getsizeof(n)
+        for key, value in n.items():
+            usage["memory"] += sys.getsizeof(value)
+            if key == "children":
+                for name, child in value.items():
+                    usage["memory"] += sys.getsizeof(name)
+                    stack.append(child)
+            elif key == "content_bytes":
+                usage["payload"] += len(value)
+            elif key == "content":
+                # UTF-8 size; ASCII text needs no encoding to know it
+                usage["payload"] += len(value) if value.isascii() else len(value.encode("utf-8"))
+    return usage
+
+def parse_size(text):
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    m = re.fullmatch(r"(\d+)([KMG]?)B?", text.upper())
+    if m is None:
+        raise ValueError(f"invalid size: {text!r}")
+    return int(m.group(1)) * units[m.group(2)]
+
+def file_data(node):
+    if "content_bytes" in node:
+        return node["content_bytes"]
+    return node.get("content", "").encode("utf-8")
+
+def trigrams(data):
+    # each 3-byte sequence packed into one int
+    return {(a << 16) | (b << 8) | c for a, b, c in zip(data, data[1:], data[2:])}
+
+# larger payloads are not indexed; searches always check them directly
+INDEX_MAX_BYTES = 64 * 1024
+
+class TrigramIndex:
+    # maps trigrams to arrays of file ids; a file's trigrams are not kept,
+    # removal recomputes them from the content
+    def __init__(self, root_path, root_node, check=None):
+        self.root_path = tuple(root_path)
+        self.postings = {}
+        self.paths = []
+        self.ids = {}
+        self.unindexed = set()
+        self.add_tree(self.root_path, root_node, check)
+
+    def add_tree(self, path, node, check=None):
+        stack = [(node, tuple(path))]
+        while stack:
+            if check is not None:
+                check()
+            n, p = stack.pop()
+            if n.get("type") == "file":
+                self.add(p, file_data(n))
+            for name, child in n.get("children", {}).items():
+                stack.append((child, p + (name,)))
+
+    def remove_tree(self, path, node):
+        stack = [(node, tuple(path))]
+        while stack:
+            n, p = stack.pop()
+            if n.get("type") == "file":
+                self.remove(p, file_data(n))
+            for name, child in n.get("children", {}).items():
+                stack.append((child, p + (name,)))
+
+    def add(self, path, data):
+        file_id = self.ids[path] = len(self.paths)
+        self.paths.append(path)
+        if len(data) > INDEX_MAX_BYTES:
+            self.unindexed.add(file_id)
+            return
+        for g in trigrams(data):
+            posting = self.postings.get(g)
+            if posting is None:
+                posting = self.postings[g] = array("I")
+            posting.append(file_id)
+
+    def remove(self, path, data):
+        file_id = self.ids.pop(path, None)
+        if file_id is None:
+            return
+        self.paths[file_id] = None
+        if file_id in self.unindexed:
+            self.unindexed.discard(file_id)
+            return
+        for g in trigrams(data):
+            posting = self.postings[g]
+            posting.remove(file_id)
+            if not posting:
+                del self.postings[g]
+
+    def candidates(self, needle):
+        # files that may contain needle; short needles can't be narrowed down
+        grams = trigrams(needle)
+        if not grams:
+            return set(self.ids)
+        postings = sorted((self.postings.get(g, ()) for g in grams), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(posting)
+        result |= self.unindexed
+        return {self.paths[i] for i in result}
+
+def copy_up(node):
+    # shallow copy owned by the upper layer; grandchildren stay shared
+    new = dict(node)
+    if "children" in node:
+        new["children"] = dict(node["children"])
+    return new
+
+def copy_tree(node, check=None):
+    # iterative deep copy of the node dicts; str/bytes payloads are immutable
+    # and shared, as copy.deepcopy would do
+    root = dict(node)
+    stack = [root]
+    while stack:
+        if check is not None:
+            check()
+        n = stack.pop()
+        if "children" in n:
+            children = {}
+            for name, child in n["children"].items():
+                children[name] = dict(child)
+                stack.append(children[name])
+            n["children"] = children
+    return root
+
+def node_overhead(node):
+    # the part of subtree_usage that belongs to the node dict itself
+    size = sys.getsizeof(node)
+    if "children" in node:
+        size += sys.getsizeof(node["children"])
+    return size
+
+def apply_layer(base, delta):
+    # merge one upper layer onto base; unchanged base subtrees are shared
+    if delta.get("type") == "whiteout":
+        return None
+    node = {k: v for k, v in delta.items() if k not in ("children", "opaque")}
+    if delta.get("type") != "dir":
+        return node
+    merge = base is not None and base.get("type") == "dir" and not delta.get("opaque")
+    children = dict(base.get("children", {})) if merge else {}
+    for name, child in delta.get("children", {}).items():
+        merged = apply_layer(children.get(name) if merge else None, child)
+        if merged is None:
+            children.pop(name, None)
+        else:
+            children[name] = merged
+    node["children"] = children
+    return node
+
+def layer_delta(upper, lower):
+    # inverse of apply_layer: what has to be stored on top of lower
+    if upper.get("type") != "dir" or lower is None or lower.get("type") != "dir":
+        return dict(upper, opaque=True) if upper.get("type") == "dir" else upper
+    delta = {k: v for k, v in upper.items() if k != "children"}
+    children = {}
+    lower_children = lower.get("children", {})
+    for name, child in upper.get("children", {}).items():
+        lower_child = lower_children.get(name)
+        if child is not lower_child:
+            children[name] = layer_delta(child, lower_child)
+    for name in lower_children:
+        if name not in upper.get("children", {}):
+            children[name] = {"type": "whiteout"}
+    delta["children"] = children
+    return delta
+
+@functools.lru_cache(maxsize=4096)
+def normalize_path(cwd, raw):
+    # cwd and result are tuples of interned components; "." and ".." are
+    # resolved lexically, ".." at the root stays at the root
+    parts = [] if raw.startswith("/") else list(cwd)
+    for c in raw.split("/"):
+        if c == "" or c == ".":
+            continue
+        if c == "..":
+            if parts:
+                parts.pop()
+            continue
+        parts.append(sys.intern(c))
+    return tuple(parts)
+
+# multiple of 3 so every chunk encodes to base64 without padding
+B64_CHUNK = 3 * 16384
+
+def write_node_json(node, f, check=None):
+    # depth-first streaming encoder: only the current path of child
+    # iterators is held in memory, never the whole document
+    dump = lambda v: json.dumps(v, ensure_ascii=False)
+
+    def open_node(n):
+        f.write("{")
+        sep = ""
+        for key, value in n.items():
+            if key in ("children", "content_bytes", "content_b64"):
+                continue
+            f.write(f"{sep}{dump(key)}: {dump(value)}")
+            sep = ", "
+        if "content_bytes" in n:
+            f.write(f'{sep}"content_b64": "')
+            data = memoryview(n["content_bytes"])
+            for i in range(0, len(data), B64_CHUNK):
+                f.write(base64.b64encode(data[i:i + B64_CHUNK]).decode("ascii"))
+            f.write('"')
+        elif "content_b64" in n:
+            f.write(f'{sep}"content_b64": {dump(n["content_b64"])}')
+        if n.get("type") == "dir":
+            f.write(f'{sep}"children": {{')
+            stack.append([iter(n.get("children", {}).items()), True])
+        else:
+            f.write("}")
+
+    stack = []
+    open_node(node)
+    while stack:
+        if check is not None:
+            check()
+        top = stack[-1]
+        item = next(top[0], None)
+        if item is None:
+            stack.pop()
+            f.write("}}")
+            continue
+        if not top[1]:
+            f.write(", ")
+        top[1] = False
+        f.write(f"{dump(item[0])}: ")
+        open_node(item[1])
+
 class VFS:
     def __init__(self, root=None, name="VFS"):
         self.name = name
         self.root = root if root is not None else default_vfs()
-        self.cwd = []
+        self.cwd = ()
+        # mutation events: subscribers get every event, the history is kept
+        # only while there are snapshots to diff against
+        self.subscribers = []
+        self.structure_hooks = []
+        self.event_log = None
+        self.event_seq = 0
+        self.events = []
+        self.snapshots = {}
+        # memory accounting: totals for the whole tree and per-quota usage
+        self.stats = None
+        self.quotas = {}
+        # trigram indexes for content search, built lazily per searched subtree
+        self.indexes = {}
+        # commands run on worker threads: one at a time under the lock, each
+        # with its own cancel token checked between nodes of long traversals
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # read-only lower image: its nodes are shared with self.root and are
+        # copied up before any write, so the session costs only its delta
+        self.lower_root = None
+        self.lower_ids = set()
+
+    def mount_layers(self, lower, uppers=()):
+        merged = lower
+        for delta in uppers:
+            merged = apply_layer(merged, delta)
+        self.root = self.lower_root = merged
+        self.lower_ids = set()
+        stack = [merged]
+        while stack:
+            n = stack.pop()
+            self.lower_ids.add(id(n))
+            stack.extend(n.get("children", {}).values())
+        self.cwd = ()
+        self.stats = None
+        self.indexes = {}
+
+    def writable(self, path_list):
+        # node at path_list with every node on the way owned by the upper layer
+        if id(self.root) in self.lower_ids:
+            self.root = self.copy_up_at((), self.root)
+        node = self.root
+        for i, comp in enumerate(path_list):
+            if node.get("type") != "dir":
+                return None
+            children = node.get("children", {})
+            child = children.get(comp)
+            if child is None:
+                return None
+            if id(child) in self.lower_ids:
+                child = children[comp] = self.copy_up_at(tuple(path_list[:i + 1]), child)
+            node = child
+        return node
+
+    def copy_up_at(self, path, node):
+        new = copy_up(node)
+        if self.stats is not None or self.quotas:
+            self.adjust_usage(path, node_overhead(new) - node_overhead(node))
+        return new
+
+    def save_layer(self, out_path):
+        if self.lower_root is None:
+            delta = dict(self.root, opaque=True)
+        elif self.root is self.lower_root:
+            delta = {"type": "dir", "mode": self.root.get("mode", ""), "children": {}}
+        else:
+            delta = layer_delta(self.root, self.lower_root)
+        self.write_json_file(out_path, delta)
+
+    def checkpoint(self):
+        token = getattr(self.local, "token", None)
+        if token is not None:
+            token.check()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback)
+
+    def on_structure_change(self, callback):
+        # cheap hook: called once per mutation with the path of the replaced
+        # node (None after vfs-init), without the per-node event stream
+        self.structure_hooks.append(callback)
+        return lambda: self.structure_hooks.remove(callback)
+
+    def structure_changed(self, path_list):
+        for cb in list(self.structure_hooks):
+            cb(path_list)
+
+    def open_event_log(self, path):
+        self.close_event_log()
+        self.event_log = open(path, "a", encoding="utf-8")
+
+    def flush_event_log(self):
+        # once per command, not per event
+        if self.event_log is not None:
+            self.event_log.flush()
+
+    def close_event_log(self):
+        if self.event_log is not None:
+            self.event_log.close()
+            self.event_log = None
+
+    def listening(self):
+        return bool(self.subscribers or self.snapshots or self.event_log is not None)
+
+    def emit(self, op, path_list, old, new):
+        self.event_seq += 1
+        event = {"seq": self.event_seq, "op": op, "path": "/" + "/".join(path_list),
+                 "old": old, "new": new}
+        if self.snapshots:
+            self.events.append(event)
+        if self.event_log is not None:
+            self.event_log.write(json.dumps(event, ensure_ascii=False) + "\n")
+        for cb in list(self.subscribers):
+            cb(event)
+
+    def snapshot(self, name):
+        self.snapshots[name] = self.event_seq
+
+    def drop_snapshot(self, name):
+        if name not in self.snapshots:
+            raise ValueError(f"no such snapshot: {name}")
+        del self.snapshots[name]
+        # forget history nobody can ask for anymore
+        oldest = min(self.snapshots.values(), default=self.event_seq)
+        self.events = self.events[self.events_index(oldest):]
+
+    def events_index(self, seq):
+        return bisect.bisect_right(self.events, seq, key=lambda e: e["seq"])
+
+    def diff(self, name):
+        # coalesced changes since the snapshot: path -> (op, old, new)
+        if name not in self.snapshots:
+            raise ValueError(f"no such snapshot: {name}")
+        changes = {}
+        for event in self.events[self.events_index(self.snapshots[name]):]:
+            if event["op"] == "reset":
+                changes = {event["path"]: ("reset", None, None)}
+                continue
+            prev = changes.get(event["path"])
+            old = prev[1] if prev is not None else event["old"]
+            changes[event["path"]] = (event["op"], old, event["new"])
+        result = []
+        for path, (op, old, new) in changes.items():
+            if op != "reset" and old == new:
+                continue
+            result.append((path, op, old, new))
+        return result
 
     @staticmethod
     def load_from_json(path):
@@ -49,10 +562,8 @@ class VFS:
         return raw
 
     def path_list_from_str(self, pstr):
-        if pstr.startswith("/"):
-            comps = [c for c in pstr.split("/") if c]
-            return comps
-        return self.cwd + [c for c in pstr.split("/") if c]
+        # absolute paths share cache entries regardless of cwd
+        return normalize_path(() if pstr.startswith("/") else self.cwd, pstr)
 
     def path_to_parent_and_name(self, path_list):
         if not path_list:
@@ -87,51 +598,133 @@ class VFS:
     def change_dir(self, target):
         if target == "":
             return
-        if target.startswith("/"):
-            comps = [c for c in target.split("/") if c]
-            new = []
-        else:
-            comps = [c for c in target.split("/") if c]
-            new = self.cwd.copy()
-        for c in comps:
-            if c == ".":
-                continue
-            if c == "..":
-                if new:
-                    new.pop()
-                continue
-            node = self.path_to_node(new)
-            if node is None:
-                raise FileNotFoundError("Path does not exist")
+        new = self.path_list_from_str(target)
+        node = self.root
+        for c in new:
             child = node.get("children", {}).get(c)
             if child is None or child.get("type") != "dir":
                 raise NotADirectoryError(f"{c} is not a directory")
-            new.append(c)
+            node = child
         self.cwd = new
 
     def cwd_path(self):
         return "/" + "/".join(self.cwd)
 
-    def find(self, start_path_list, pattern):
+    def find(self, start_path_list, pattern, contains=None):
         start_node = self.path_to_node(start_path_list)
         if start_node is None:
             raise FileNotFoundError("Start path not found")
+        if contains is not None:
+            results = []
+            for path, _ in self.search_content(start_path_list, contains):
+                if pattern is None or fnmatch.fnmatch(path[-1], pattern):
+                    results.append("/" + "/".join(path))
+            return results
         results = []
         def rec(node, path_prefix):
             if node.get("type") == "dir":
                 for name, child in node.get("children", {}).items():
+                    self.checkpoint()
                     p = path_prefix + [name]
                     if fnmatch.fnmatch(name, pattern):
                         results.append("/" + "/".join(p))
                     rec(child, p)
-        rec(start_node, start_path_list.copy())
+        rec(start_node, list(start_path_list))
         return results
 
-    def chmod(self, path_list, mode_str):
-        node = self.path_to_node(path_list)
+    def content_index(self, path_list):
+        path = tuple(path_list)
+        for root, index in self.indexes.items():
+            if path[:len(root)] == root:
+                return index
+        node = self.path_to_node(path)
+        # built before anything is replaced, so a cancelled build changes nothing
+        index = TrigramIndex(path, node, self.checkpoint)
+        # a new index over a wider subtree replaces the ones it covers
+        for root in [r for r in self.indexes if r[:len(path)] == path]:
+            del self.indexes[root]
+        self.indexes[path] = index
+        return index
+
+    def search_content(self, path_list, text):
+        # (path, node) of files under path_list whose content contains text;
+        # only the index candidates are decoded and checked
+        path = tuple(path_list)
+        if self.path_to_node(path) is None:
+            raise FileNotFoundError("No such file or directory")
+        needle = text.encode("utf-8")
+        index = self.content_index(path)
+        results = []
+        for p in sorted(index.candidates(needle)):
+            self.checkpoint()
+            if p[:len(path)] != path:
+                continue
+            node = self.path_to_node(p)
+            if node is None or node.get("type") != "file":
+                continue
+            if "content_bytes" in node:
+                found = needle in node["content_bytes"]
+            else:
+                found = text in node.get("content", "")
+            if found:
+                results.append((p, node))
+        return results
+
+    def update_indexes(self, path, old_node, new_node):
+        for root in list(self.indexes):
+            if path[:len(root)] == root:
+                index = self.indexes[root]
+                if old_node is not None:
+                    index.remove_tree(path, old_node)
+                index.add_tree(path, new_node)
+            elif root[:len(path)] == path:
+                # the index root itself was replaced; rebuild on next search
+                del self.indexes[root]
+
+    def chmod(self, path_list, mode_str, recursive=False):
+        # parsed before copy-up so an invalid mode leaves the overlay untouched
+        apply = parse_mode_spec(mode_str)
+        absolute = re.fullmatch(r"[0-7]{1,4}", mode_str) is not None
+        node = self.writable(path_list)
         if node is None:
             raise FileNotFoundError("No such file or directory")
-        node["mode"] = mode_str
+        default_bits = {"dir": 0o755, "file": 0o644}
+        listening = self.listening()
+        # trees hold few distinct modes: convert each (mode, is_dir) once
+        converted = {}
+        # iterative walk over node dicts, each node is visited exactly once;
+        # if cancelled, nodes already changed keep their mode and their events
+        stack = [(node, tuple(path_list))]
+        while stack:
+            self.checkpoint()
+            n, p = stack.pop()
+            is_dir = n.get("type") == "dir"
+            old = n.get("mode")
+            new = converted.get((old, is_dir))
+            if new is None:
+                # an unreadable stored mode counts as the type default rather
+                # than aborting the walk halfway
+                bits = default_bits.get(n.get("type"), 0o644)
+                if old and not absolute:
+                    try:
+                        bits = mode_to_bits(old)
+                    except ValueError:
+                        pass
+                new = converted[(old, is_dir)] = bits_to_mode(apply(bits, is_dir))
+            if new != old:
+                if listening:
+                    old_meta = node_meta(n)
+                    n["mode"] = new
+                    self.emit("chmod", p, old_meta, dict(old_meta, mode=new))
+                else:
+                    n["mode"] = new
+                    self.event_seq += 1
+            if recursive and is_dir:
+                children = n.get("children", {})
+                for name, child in children.items():
+                    if id(child) in self.lower_ids:
+                        child = children[name] = self.copy_up_at(p + (name,), child)
+                    stack.append((child, p + (name,)))
 
     def cp(self, src_list, dst_list):
         src_node = self.path_to_node(src_list)
@@ -140,6 +733,7 @@ class VFS:
         dst_parent, dst_name = self.path_to_parent_and_name(dst_list)
         if dst_parent is None:
             raise FileNotFoundError("Destination parent not found")
+        dst_path = tuple(dst_list)
         # if dst exists and is dir -> copy into dir with same basename
         existing = dst_parent.get("children", {}).get(dst_name)
         if existing and existing.get("type") == "dir" and src_node.get("type") == "dir":
@@ -148,14 +742,138 @@ class VFS:
             new_name = src_list[-1]
             dst_parent = existing
             dst_name = new_name
-        # create deep copy of node
-        new_node = copy.deepcopy(src_node)
+            dst_path += (new_name,)
+            existing = existing.get("children", {}).get(new_name)
+        # size the write up front so a quota violation fails before copying
+        new_usage = old_usage = None
+        if self.quotas or self.stats is not None:
+            new_usage = subtree_usage(src_node, self.checkpoint)
+            old_usage = subtree_usage(existing, self.checkpoint)
+            self.check_quota(dst_path, new_usage["memory"] - old_usage["memory"])
+        # create deep copy of node; cancelling it leaves the tree untouched
+        new_node = copy_tree(src_node, self.checkpoint)
         # insert
+        dst_parent = self.writable(dst_path[:-1])
+        before = node_overhead(dst_parent)
         dst_parent.setdefault("children", {})[dst_name] = new_node
+        if new_usage is not None:
+            self.account(dst_path, new_usage, old_usage)
+            # the parent's children dict may have grown, plus the new name
+            growth = node_overhead(dst_parent) - before
+            if existing is None:
+                growth += sys.getsizeof(dst_name)
+            self.adjust_usage(dst_path[:-1], growth)
+        if self.indexes:
+            self.update_indexes(dst_path, existing, new_node)
+        self.structure_changed(dst_path)
+        self.emit_tree("cp", dst_path, existing, new_node)
+
+    def usage(self):
+        # computed once, then kept up to date by the mutating commands
+        if self.stats is None:
+            self.stats = subtree_usage(self.root, self.checkpoint)
+        return self.stats
+
+    def set_quota(self, path_list, limit):
+        node = self.path_to_node(path_list)
+        if node is None:
+            raise FileNotFoundError("No such file or directory")
+        if node.get("type") != "dir":
+            raise NotADirectoryError("Not a directory")
+        used = subtree_usage(node, self.checkpoint)["memory"]
+        self.quotas[tuple(path_list)] = {"limit": limit, "used": used}
+
+    def remove_quota(self, path_list):
+        if self.quotas.pop(tuple(path_list), None) is None:
+            raise ValueError("no quota set")
+
+    def check_quota(self, path, delta):
+        for q, entry in self.quotas.items():
+            if path[:len(q)] == q and entry["used"] + delta > entry["limit"]:
+                raise OSError(f"quota exceeded for {'/' + '/'.join(q)} "
+                              f"({entry['used'] + delta} > {entry['limit']} bytes)")
+
+    def adjust_usage(self, path, delta):
+        if self.stats is not None:
+            self.stats["memory"] += delta
+        for q, entry in self.quotas.items():
+            if path[:len(q)] == q:
+                entry["used"] += delta
+
+    def account(self, path, new_usage, old_usage):
+        if self.stats is not None:
+            for k in self.stats:
+                self.stats[k] += new_usage[k] - old_usage[k]
+        delta = new_usage["memory"] - old_usage["memory"]
+        for q, entry in self.quotas.items():
+            if path[:len(q)] == q:
+                entry["used"] += delta
+            elif q[:len(path)] == path:
+                # the quota root itself was inside the replaced subtree
+                node = self.path_to_node(q)
+                entry["used"] = subtree_usage(node)["memory"] if node else 0
+
+    def emit_tree(self, op, path_list, old_node, new_node):
+        # one event per node of the new subtree, so mirrors can replay it,
+        # and a "delete" for every old node that has no counterpart in it
+        if not self.listening():
+            self.event_seq += 1
+            return
+        self.emit(op, path_list, node_meta(old_node), node_meta(new_node))
+        stack = [(new_node, old_node, path_list)]
+        while stack:
+            n, old, p = stack.pop()
+            children = n.get("children", {}) if n.get("type") == "dir" else {}
+            old_children = old.get("children", {}) if old is not None and old.get("type") == "dir" else {}
+            for name, child in children.items():
+                cp = p + (name,)
+                old_child = old_children.get(name)
+                self.emit(op, cp, node_meta(old_child), node_meta(child))
+                stack.append((child, old_child, cp))
+            for name, old_child in old_children.items():
+                if name not in children:
+                    self.emit_deleted(p + (name,), old_child)
+
+    def emit_deleted(self, path_list, node):
+        stack = [(node, path_list)]
+        while stack:
+            n, p = stack.pop()
+            self.emit("delete", p, node_meta(n), None)
+            for name, child in n.get("children", {}).items():
+                stack.append((child, p + (name,)))
 
     def vfs_init_default(self):
         self.root = default_vfs()
-        self.cwd = []
+        self.cwd = ()
+        self.lower_root = None
+        self.lower_ids = set()
+        self.stats = None
+        self.indexes = {}
+        for q, entry in self.quotas.items():
+            node = self.path_to_node(q)
+            entry["used"] = subtree_usage(node)["memory"] if node else 0
+        self.structure_changed(None)
+        self.emit("reset", (), None, node_meta(self.root))
+
+    def export_json(self, out_path, path_list):
+        node = self.path_to_node(path_list)
+        if node is None:
+            raise FileNotFoundError("No such file or directory")
+        self.write_json_file(out_path, node)
+
+    def write_json_file(self, out_path, node):
+        # written next to the target and renamed only once complete, so a
+        # failed or cancelled write never leaves truncated JSON behind
+        tmp_path = out_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                write_node_json(node, f, self.checkpoint)
+                f.write("\n")
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
 def expand_vars(s: str) -> str:
     return os.path.expandvars(s)
@@ -163,6 +881,11 @@ def expand_vars(s: str) -> str:
 def pretty_path(vfs: VFS, path_list):
     return "/" + "/".join(path_list)
 
+COMMANDS = sorted([
+    "exit", "ls", "cd", "echo", "find", "grep", "chmod", "cp", "snapshot", "diff",
+    "export", "vfs-stats", "quota", "overlay-save", "vfs-init", "jobs", "kill",
+])
+
 def handle_cmd(vfs: VFS, tokens):
     if not tokens:
         return False
@@ -173,7 +896,7 @@ def handle_cmd(vfs: VFS, tokens):
             return True
         elif cmd == "ls":
             target = args[0] if args else "."
-            path_list = vfs.path_list_from_str(target) if target != "." else vfs.cwd
+            path_list = vfs.path_list_from_str(target)
             try:
                 items = vfs.list_dir(path_list)
                 for name, node in items:
@@ -191,32 +914,100 @@ def handle_cmd(vfs: VFS, tokens):
         elif cmd == "echo":
             print(" ".join(args))
         elif cmd == "find":
-            if len(args) >= 3 and args[1] == "-name":
+            preds = dict(zip(args[1::2], args[2::2]))
+            if len(args) >= 3 and len(args) % 2 == 1 and set(preds) <= {"-name", "-contains"}:
                 start = args[0]
-                pattern = args[2]
-                start_list = vfs.path_list_from_str(start) if start != "." else vfs.cwd
-                res = vfs.find(start_list, pattern)
+                start_list = vfs.path_list_from_str(start)
+                res = vfs.find(start_list, preds.get("-name"), preds.get("-contains"))
                 for r in res:
                     print(r)
             else:
-                print("find: usage: find <path> -name <pattern>")
+                print("find: usage: find <path> [-name <pattern>] [-contains <text>]")
+        elif cmd == "grep":
+            if len(args) not in (1, 2):
+                print("grep: usage: grep <text> [path]")
+            else:
+                text = args[0]
+                start_list = vfs.path_list_from_str(args[1] if len(args) == 2 else ".")
+                for path, node in vfs.search_content(start_list, text):
+                    p = "/" + "/".join(path)
+                    if "content_bytes" in node:
+                        print(f"Binary file {p} matches")
+                        continue
+                    for line in node.get("content", "").splitlines():
+                        if text in line:
+                            print(f"{p}:{line}")
         elif cmd == "chmod":
+            recursive = bool(args) and args[0] == "-R"
+            if recursive:
+                args = args[1:]
             if len(args) != 2:
-                print("chmod: usage: chmod <mode> <path>")
+                print("chmod: usage: chmod [-R] <mode> <path>")
             else:
                 mode_str = args[0]
                 path = args[1]
-                path_list = vfs.path_list_from_str(path) if path != "/" else []
-                vfs.chmod(path_list, mode_str)
+                path_list = vfs.path_list_from_str(path)
+                vfs.chmod(path_list, mode_str, recursive=recursive)
         elif cmd == "cp":
             if len(args) != 2:
                 print("cp: usage: cp <src> <dst>")
             else:
                 src = args[0]
                 dst = args[1]
-                src_list = vfs.path_list_from_str(src) if src != "/" else []
-                dst_list = vfs.path_list_from_str(dst) if dst != "/" else []
+                src_list = vfs.path_list_from_str(src)
+                dst_list = vfs.path_list_from_str(dst)
                 vfs.cp(src_list, dst_list)
+        elif cmd == "snapshot":
+            if len(args) == 2 and args[0] == "-d":
+                vfs.drop_snapshot(args[1])
+            elif len(args) == 1:
+                vfs.snapshot(args[0])
+            else:
+                print("snapshot: usage: snapshot [-d] <name>")
+        elif cmd == "diff":
+            if len(args) != 1:
+                print("diff: usage: diff <snapshot>")
+            else:
+                for path, op, old, new in vfs.diff(args[0]):
+                    if op == "reset":
+                        print(f"R\t{path}")
+                    elif old is None:
+                        print(f"A\t{path}")
+                    elif new is None:
+                        print(f"D\t{path}")
+                    elif old.get("type") != new.get("type"):
+                        print(f"M\t{path}\t{old.get('type')} {old.get('mode')} -> "
+                              f"{new.get('type')} {new.get('mode')}")
+                    else:
+                        print(f"M\t{path}\t{old.get('mode')} -> {new.get('mode')}")
+        elif cmd == "export":
+            if len(args) not in (1, 2):
+                print("export: usage: export <file> [path]")
+            else:
+                target = args[1] if len(args) == 2 else "/"
+                path_list = vfs.path_list_from_str(target)
+                vfs.export_json(args[0], path_list)
+                print(f"VFS exported to {args[0]}")
+        elif cmd == "vfs-stats":
+            usage = vfs.usage()
+            print(f"nodes: {usage['nodes']} (dirs: {usage['dirs']}, files: {usage['files']})")
+            print(f"payload: {usage['payload']} bytes")
+            print(f"memory: {usage['memory']} bytes")
+            for q, entry in vfs.quotas.items():
+                print(f"quota {'/' + '/'.join(q)}: {entry['used']} / {entry['limit']} bytes")
+        elif cmd == "quota":
+            if len(args) == 2 and args[0] == "-d":
+                vfs.remove_quota(vfs.path_list_from_str(args[1]))
+            elif len(args) == 2:
+                vfs.set_quota(vfs.path_list_from_str(args[0]), parse_size(args[1]))
+            else:
+                print("quota: usage: quota <path> <size> | quota -d <path>")
+        elif cmd == "overlay-save":
+            if len(args) != 1:
+                print("overlay-save: usage: overlay-save <file>")
+            else:
+                vfs.save_layer(args[0])
+                print(f"Upper layer saved to {args[0]}")
         elif cmd == "vfs-init":
             vfs.vfs_init_default()
             print("VFS reset to default (in-memory).")
@@ -226,7 +1017,172 @@ def handle_cmd(vfs: VFS, tokens):
         print(f"{cmd}: {e}")
     return False
 
-def run_script(path, vfs):
+class JobTable:
+    def __init__(self):
+        self.jobs = {}
+        self.next_id = 1
+
+    def start(self, vfs, tokens, text):
+        job = {"id": self.next_id, "text": text, "token": CancelToken(), "exit": False,
+               "done": threading.Event()}
+        self.next_id += 1
+
+        def target():
+            vfs.local.token = job["token"]
+            try:
+                # wait for the lock in slices so a queued command can be cancelled
+                while not vfs.lock.acquire(timeout=0.1):
+                    job["token"].check()
+                try:
+                    job["token"].check()
+                    job["exit"] = handle_cmd(vfs, tokens)
+                finally:
+                    vfs.flush_event_log()
+                    vfs.lock.release()
+            except Cancelled as e:
+                print(f"{tokens[0]}: {e}")
+            finally:
+                vfs.local.token = None
+                job["done"].set()
+
+        job["thread"] = threading.Thread(target=target, daemon=True)
+        self.jobs[job["id"]] = job
+        job["thread"].start()
+        return job
+
+    def wait(self, job):
+        # Ctrl-C cancels the job; it stops at its next checkpoint.
+        # Waits on an Event: an interrupted Thread.join can leave is_alive() wrong
+        while not job["done"].is_set():
+            try:
+                job["done"].wait(0.1)
+            except KeyboardInterrupt:
+                print("^C")
+                job["token"].cancel()
+        del self.jobs[job["id"]]
+        return job["exit"]
+
+    def reap(self):
+        for job_id, job in list(self.jobs.items()):
+            if job["done"].is_set() and job.get("background"):
+                print(f"[{job_id}] Done\t{job['text']}")
+                del self.jobs[job_id]
+
+    def kill(self, spec):
+        job = self.jobs.get(int(spec.lstrip("%")))
+        if job is None:
+            raise ValueError(f"no such job: {spec}")
+        job["token"].cancel()
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            job["token"].cancel()
+        for job in self.jobs.values():
+            job["thread"].join()
+
+def dispatch(vfs, jobs, tokens):
+    if not tokens:
+        return False
+    if tokens[-1] == "&":
+        if len(tokens) > 1:
+            job = jobs.start(vfs, tokens[:-1], " ".join(tokens[:-1]))
+            job["background"] = True
+            print(f"[{job['id']}] {job['text']}")
+        return False
+    if tokens[0] == "jobs":
+        for job_id, job in jobs.jobs.items():
+            state = "Done" if job["done"].is_set() else "Running"
+            print(f"[{job_id}] {state}\t{job['text']}")
+        return False
+    if tokens[0] == "kill":
+        if len(tokens) != 2:
+            print("kill: usage: kill %<job>")
+            return False
+        try:
+            jobs.kill(tokens[1])
+        except ValueError as e:
+            print(f"kill: {e}")
+        return False
+    return jobs.wait(jobs.start(vfs, tokens, " ".join(tokens)))
+
+class Completer:
+    # readline completer for command names and VFS paths; sorted child names
+    # are cached per directory and dropped when a mutation touches them
+    def __init__(self, vfs):
+        self.vfs = vfs
+        self.listings = {}
+        self.matches = []
+        vfs.on_structure_change(self.invalidate)
+
+    def invalidate(self, path):
+        if path is None:
+            self.listings.clear()
+            return
+        # the parent gained or replaced one entry: keep its listing sorted in
+        # place; listings at or below path belong to the replaced subtree
+        names = self.listings.get(path[:-1])
+        if names is not None and path:
+            i = bisect.bisect_left(names, path[-1])
+            if i == len(names) or names[i] != path[-1]:
+                names.insert(i, path[-1])
+        for cached in [p for p in self.listings if p[:len(path)] == path]:
+            del self.listings[cached]
+
+    def listing(self, path):
+        node = self.vfs.path_to_node(path)
+        if node is None or node.get("type") != "dir":
+            return None, []
+        names = self.listings.get(path)
+        if names is None:
+            names = self.listings[path] = sorted(node.get("children", {}))
+        return node, names
+
+    def complete_path(self, text):
+        dir_part, _, prefix = text.rpartition("/")
+        if text.startswith("/") and not dir_part:
+            dir_part = "/"
+        base = dir_part + "/" if dir_part and dir_part != "/" else dir_part
+        node, names = self.listing(self.vfs.path_list_from_str(dir_part or "."))
+        if node is None:
+            return []
+        # prefix range in the sorted names
+        lo = bisect.bisect_left(names, prefix)
+        hi = bisect.bisect_left(names, prefix + "\U0010ffff", lo)
+        children = node.get("children", {})
+        result = []
+        for name in names[lo:hi]:
+            child = children.get(name)
+            if child is not None:
+                result.append(base + name + ("/" if child.get("type") == "dir" else ""))
+        return result
+
+    def complete(self, text, state):
+        if state == 0:
+            self.matches = []
+            # don't read the tree while a job is changing it
+            if not self.vfs.lock.acquire(timeout=0.05):
+                return None
+            try:
+                line = readline.get_line_buffer()[:readline.get_begidx()]
+                if line.strip() == "":
+                    lo = bisect.bisect_left(COMMANDS, text)
+                    self.matches = [c for c in COMMANDS[lo:] if c.startswith(text)]
+                else:
+                    self.matches = self.complete_path(text)
+            finally:
+                self.vfs.lock.release()
+        return self.matches[state] if state < len(self.matches) else None
+
+def setup_completion(vfs):
+    if readline is None:
+        return None
+    completer = Completer(vfs)
+    readline.set_completer(completer.complete)
+    readline.set_completer_delims(" \t")
+    readline.parse_and_bind("tab: complete")
+    return completer
+
+def run_script(path, vfs, jobs):
     print(f"--- Выполнение стартового скрипта {path} ---")
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -242,7 +1198,7 @@ def run_script(path, vfs):
                 except ValueError as e:
                     print(f"Parse error: {e}")
                     continue
-                if handle_cmd(vfs, tokens):
+                if dispatch(vfs, jobs, tokens):
                     print("Script interrupted by exit.")
                     return
     except FileNotFoundError:
@@ -253,6 +1209,9 @@ def main():
     parser = argparse.ArgumentParser(description="Эмулятор оболочки — этап 5 (chmod, cp)")
     parser.add_argument("--vfs-path", help="Путь к JSON-файлу VFS", default=None)
     parser.add_argument("--start-script", help="Путь к стартовому скрипту", default=None)
+    parser.add_argument("--overlay", help="JSON-слой изменений поверх --vfs-path (можно несколько)",
+                        action="append", default=[])
+    parser.add_argument("--event-log", help="Путь к JSONL-журналу изменений VFS", default=None)
     args = parser.parse_args()
 
     print("DEBUG: параметры запуска:")
@@ -263,22 +1222,37 @@ def main():
         try:
             root = VFS.load_from_json(args.vfs_path)
             vfs = VFS(root=root, name=os.path.basename(args.vfs_path) or "VFS")
+            vfs.mount_layers(root, [VFS.load_from_json(p) for p in args.overlay])
             print(f"VFS загружён из {args.vfs_path}")
         except Exception as e:
             print(f"Не удалось загрузить VFS: {e}")
             vfs = VFS()
     else:
+        if args.overlay:
+            print("--overlay требует --vfs-path: слои не загружены")
         vfs = VFS()
 
+    if args.event_log:
+        try:
+            vfs.open_event_log(args.event_log)
+        except OSError as e:
+            print(f"Не удалось открыть журнал изменений: {e}")
+
+    jobs = JobTable()
+    setup_completion(vfs)
     if args.start_script:
-        run_script(args.start_script, vfs)
+        run_script(args.start_script, vfs, jobs)
 
     while True:
+        jobs.reap()
         try:
             raw = input(f"{vfs.name}:{vfs.cwd_path()}$ ")
         except EOFError:
             print()
             break
+        except KeyboardInterrupt:
+            print()
+            continue
         raw = raw.strip()
         if raw == "":
             continue
@@ -288,8 +1262,10 @@ def main():
         except ValueError as e:
             print(f"Parse error: {e}")
             continue
-        if handle_cmd(vfs, tokens):
+        if dispatch(vfs, jobs, tokens):
             break
+    jobs.shutdown()
+    vfs.close_event_log()
 
 
 if __name__ == "__main__":